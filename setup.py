@@ -43,6 +43,36 @@ You can derive a sha256 sum with the following script:
 
 You may have multiple passwords lead to the same endpoint, but a single password may only lead to one endpoint.
 
+Mapping Options
+---------------
+
+Options may follow the endpoint on a mapping line, in the format name=value. Example:
+
+    ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad = 127.0.0.1:6379 mappingRate=10M sessionRate=1M
+
+Rates are in bytes per second, and may end with K, M, or G. Each rate applies separately to each direction (to and from the client).
+
+    mappingRate=X                Limit the total bandwidth of all sessions using this password to X. Active sessions share it roughly evenly.
+    sessionRate=X                Limit the bandwidth of each session using this password to X.
+
+Use these to keep bulk transfers on one mapping from adding latency to interactive sessions on other mappings.
+
+Socket and buffer options let interactive and bulk mappings be tuned separately. Sizes may end with K, M, or G, and yes/no options also accept true/false, on/off, 1/0.
+
+    clientBufferLen=X            Override --client-buffer-len for this mapping
+    endpointBufferLen=X          Override --endpoint-buffer-len for this mapping
+    adaptiveBuffers=yes          Start at the buffer lengths above, doubling the read size while reads fill it (bulk), and shrinking back after a run of small reads (interactive)
+    tcpNoDelay=yes               Set TCP_NODELAY on the client and endpoint sockets
+    keepAlive=yes                Set SO_KEEPALIVE on the client and endpoint sockets
+    recvBuffer=X                 Set SO_RCVBUF on the client and endpoint sockets
+    sendBuffer=X                 Set SO_SNDBUF on the client and endpoint sockets
+    multiplex=yes                Carry many independent streams to the endpoint over each authenticated connection (see Multiplexing below)
+
+Example, an interactive shell and a bulk transfer service:
+
+    ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad = 127.0.0.1:22 tcpNoDelay=yes keepAlive=yes
+    edeaaff3f1774ad2888673770c6d64097e391bc362d7d6fb34982ddf0efd18cb = 127.0.0.1:873 adaptiveBuffers=yes recvBuffer=1M sendBuffer=1M mappingRate=50M
+
 
 Starting The Server (in front of other services)
 ================================================
@@ -63,6 +93,20 @@ Other Arguments:
 
     --enable-quit                This will intercept the messages "quit" and "exit" and cause them to terminate the connection.
 
+    --profile-seconds=N          When sent SIGUSR1, profile the listener and its workers for N seconds. Defaults to 30.
+    --profile-dir=/path/to/dir   Write profiles and session traces into this directory. Defaults to the system temp directory.
+    --trace-sessions             While profiling, also write a timing trace for each new session.
+
+
+Profiling
+---------
+
+Send SIGUSR1 to *socket-gatekeeperd* to profile it while it runs. The listener and each of its workers (including those started during the run) sample for --profile-seconds,
+then write a file per process (socket-gatekeeper-profile.*.txt) to --profile-dir. Each line is a stack and its sample count, in the "collapsed" format that flamegraph tools accept.
+
+With --trace-sessions, each session accepted while profiling appends one line to socket-gatekeeper-trace.PID.txt, with the milliseconds from accept to each stage:
+key sent, password received, decrypted, endpoint connected, and first byte.
+
 
 Connecting To The Server (telnet style)
 =======================================
@@ -73,12 +117,20 @@ You specify the address and port on which to connect, and it handles the RSA por
 to the screen, and then serves as an in-between to you and the endpoint.
 
 
-    Usage: ./socket-gatekeeper-connect Addr:port
+    Usage: ./socket-gatekeeper-connect [--pipe] [--password-file=/path/to/file] Addr:port
 
         Connects to a gatekeeper socket. This is basically the same as telnetting to the socket, except it will not echo the password
         back on the screen, so this is more secure.
 
 
+To script binary or bulk transfers, use *--pipe*. This copies stdin to the connection and the connection to stdout byte for byte, with large non-blocking reads and writes.
+
+When stdin ends, the gatekeeper half-closes the connection to the endpoint, and the endpoint's response is read until it closes. Use *--password-file* to avoid the prompt:
+
+
+    ./socket-gatekeeper-connect --pipe --password-file=/path/to/pw 127.0.0.1:50001 < dump.bin > response.bin
+
+
 Integrating Into Applications (socket style)
 ============================================
 
@@ -118,6 +170,33 @@ Example:
     sock.doAuthenticationFromInput()
 
 
+Multiplexing
+------------
+
+Each connection normally carries exactly one stream, so an application that needs 50 connections to the same service pays for 50 TCP setups and 50 RSA handshakes.
+
+Add the "multiplex=yes" option to a mapping to carry any number of streams over one authenticated connection instead. Every stream gets its own connection to the endpoint
+and its own flow control window, so a slow stream does not hold up the others. See socket_gatekeeper/Multiplex.py for the framing, if implementing a client in another language.
+
+
+    sock = GatekeeperSocket(socket.AF_INET, socket.SOCK_STREAM)
+
+    sock.connect( ('127.0.0.1', 51000) )
+
+    sock.doAuthentication(password)
+
+
+    stream1 = sock.openStream()
+
+    stream2 = sock.openStream()
+
+    stream1.sendall('GET key1\\r\\n')
+
+    print ( stream1.recv(4096) )
+
+    stream1.close()
+
+
 Dependencies
 ============
 
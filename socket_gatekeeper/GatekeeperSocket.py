@@ -3,6 +3,7 @@
 #    See LICENSE for more information, or https://gnu.org/licenses/old-licenses/lgpl-2.1.txt
 ###
 
+import errno
 import getpass
 import random
 import socket
@@ -10,6 +11,8 @@ import threading
 
 from Crypto.PublicKey import RSA
 
+from .Multiplex import (FRAME_OPEN, FRAME_OPENED, FRAME_DATA, FRAME_WINDOW, FRAME_CLOSE, INITIAL_WINDOW, WINDOW_UPDATE_THRESHOLD, MAX_FRAME_PAYLOAD,
+    MultiplexProtocolError, FrameReader, packFrame, packWindowFrame, unpackWindow)
 from .utils import closeSocket
 
 
@@ -20,6 +23,9 @@ class GatekeeperSocket(socket.socket):
         Call either "doAuthentication" or "doAuthenticationFromInput" after calling 'connect'. This will perform the handshake necessary to continue the connection.
 
         After authenticated, use like a normal socket object.
+
+        If the password maps to a "multiplex" mapping, instead call "openStream" as many times as needed. Each returns a GatekeeperStream,
+          an independent connection to the endpoint, all carried over this one socket.
     '''
 
 
@@ -27,17 +33,202 @@ class GatekeeperSocket(socket.socket):
         '''
             doAuthentication - Performs the authentication with given password. This is not very secure, don't use plaintext passwords.
         '''
-        publicKey = self.recv(4200)
-        encryptor = RSA.importKey(publicKey)
-        password = encryptor.encrypt(password, random.randint(1, 40))[0]
+        self._sendEncryptedPassword(password)
 
-        self.send(password + "\r\n")
-        
     def doAuthenticationFromInput(self):
         '''
             doAuthenticationFromInput - Prompts tty for password and then performs the gatekeeper handshake.
         '''
+        self._sendEncryptedPassword(getpass.getpass())
+
+    def _sendEncryptedPassword(self, password):
         publicKey = self.recv(4200)
         encryptor = RSA.importKey(publicKey)
-        self.send(encryptor.encrypt(getpass.getpass(), random.randint(1, 40))[0] + "\r\n")
+        keyLen = (encryptor.size() + 8) // 8
+
+        # Pad to the full key length (leading zeros do not change the value), so the server can find
+        #  the end of the password line even when data is sent right behind it.
+        self.sendall(encryptor.encrypt(password, random.randint(1, 40))[0].rjust(keyLen, '\x00') + "\r\n")
+
+    def startMultiplexing(self):
+        '''
+            startMultiplexing - Start the thread which reads frames from a multiplexed connection. Call after authenticating.
+
+              "openStream" calls this if it has not been called already.
+
+              Close the connection with utils.closeSocket, which shuts it down so the read thread (and every stream) ends too.
+        '''
+        if getattr(self, '_muxCondition', None) is not None:
+            return
+
+        self._muxCondition = threading.Condition()
+        self._muxSendLock = threading.Lock()
+        self._muxStreams = {}
+        self._muxLastStreamId = 0
+        self._muxClosed = False
+
+        self._muxThread = threading.Thread(target=self._muxReadLoop)
+        self._muxThread.daemon = True
+        self._muxThread.start()
+
+    def openStream(self):
+        '''
+            openStream - Open a new stream to the endpoint over this (multiplexed) connection.
+
+            @return - GatekeeperStream. Raises socket.error if the gatekeeper could not connect to the endpoint.
+        '''
+        self.startMultiplexing()
+
+        condition = self._muxCondition
+
+        # Stream ids must reach the gatekeeper in order, so allocate and send while holding the send lock
+        with self._muxSendLock:
+            with condition:
+                if self._muxClosed is True:
+                    raise socket.error(errno.ENOTCONN, 'Multiplexed connection is closed.')
+                self._muxLastStreamId += 1
+                stream = GatekeeperStream(self, self._muxLastStreamId)
+                self._muxStreams[stream.streamId] = stream
+            self.sendall(packFrame(stream.streamId, FRAME_OPEN))
+
+        with condition:
+            while stream.opened is False and stream.closed is False:
+                condition.wait()
+            if stream.closed is True:
+                raise socket.error(errno.ECONNREFUSED, stream.closeMessage or 'Stream was closed.')
+
+        return stream
+
+    def _sendMuxFrames(self, data):
+        with self._muxSendLock:
+            self.sendall(data)
+
+    def _muxReadLoop(self):
+        condition = self._muxCondition
+        frameReader = FrameReader()
+        try:
+            while True:
+                data = self.recv(65536)
+                if not data:
+                    break
+                frames = frameReader.feed(data)
+                with condition:
+                    for (streamId, frameType, payload) in frames:
+                        stream = self._muxStreams.get(streamId, None)
+                        if stream is not None:
+                            stream._handleFrame(frameType, payload)
+                    condition.notify_all()
+        except (socket.error, MultiplexProtocolError):
+            pass
+
+        with condition:
+            self._muxClosed = True
+            for stream in self._muxStreams.values():
+                stream.closed = True
+            self._muxStreams.clear()
+            condition.notify_all()
+
+
+class GatekeeperStream(object):
+    '''
+        GatekeeperStream - One stream over a multiplexed GatekeeperSocket. Use like a blocking socket: send, sendall, recv, and close.
+
+        Create these with GatekeeperSocket.openStream
+    '''
+
+    def __init__(self, gatekeeperSocket, streamId):
+        self.gatekeeperSocket = gatekeeperSocket
+        self.streamId = streamId
+
+        self.opened = False
+        self.closed = False
+        self.closeMessage = None
+
+        self.recvBuffer = ''
+        # Bytes received by the application which have not yet been credited back to the gatekeeper
+        self.uncredited = 0
+
+        self.sendWindow = INITIAL_WINDOW
+
+    def _handleFrame(self, frameType, payload):
+        # Called by the read thread, with the condition held
+        if frameType == FRAME_OPENED:
+            self.opened = True
+        elif frameType == FRAME_DATA:
+            self.recvBuffer += payload
+        elif frameType == FRAME_WINDOW:
+            self.sendWindow += unpackWindow(payload)
+        elif frameType == FRAME_CLOSE:
+            self.closed = True
+            self.closeMessage = payload or None
+            self.gatekeeperSocket._muxStreams.pop(self.streamId, None)
+        else:
+            raise MultiplexProtocolError('Unexpected frame type %d from gatekeeper.' %(frameType,))
+
+    def recv(self, bufferLen):
+        '''
+            recv - Receive up to #bufferLen bytes, blocking until some are available. Returns an empty string once the stream is closed.
+        '''
+        condition = self.gatekeeperSocket._muxCondition
+        with condition:
+            while not self.recvBuffer and self.closed is False:
+                condition.wait()
+            data = self.recvBuffer[:bufferLen]
+            self.recvBuffer = self.recvBuffer[bufferLen:]
+
+            toCredit = 0
+            if self.closed is False:
+                self.uncredited += len(data)
+                if self.uncredited >= WINDOW_UPDATE_THRESHOLD:
+                    toCredit = self.uncredited
+                    self.uncredited = 0
+
+        if toCredit:
+            self.gatekeeperSocket._sendMuxFrames(packWindowFrame(self.streamId, toCredit))
+
+        return data
+
+    def send(self, data):
+        '''
+            send - Send some of #data, blocking until the gatekeeper allows more to be sent on this stream.
+
+            @return - Number of bytes sent
+        '''
+        if not data:
+            return 0
+
+        condition = self.gatekeeperSocket._muxCondition
+        with condition:
+            while self.sendWindow <= 0 and self.closed is False:
+                condition.wait()
+            if self.closed is True:
+                raise socket.error(errno.EPIPE, 'Stream is closed.')
+            numBytes = min(len(data), self.sendWindow, MAX_FRAME_PAYLOAD)
+            self.sendWindow -= numBytes
+
+        self.gatekeeperSocket._sendMuxFrames(packFrame(self.streamId, FRAME_DATA, data[:numBytes]))
+        return numBytes
+
+    def sendall(self, data):
+        while data:
+            numSent = self.send(data)
+            data = data[numSent:]
+
+    def close(self):
+        '''
+            close - Close this stream. The GatekeeperSocket and its other streams remain open.
+        '''
+        gatekeeperSocket = self.gatekeeperSocket
+        with gatekeeperSocket._muxCondition:
+            wasClosed = self.closed
+            self.closed = True
+            gatekeeperSocket._muxStreams.pop(self.streamId, None)
+            gatekeeperSocket._muxCondition.notify_all()
+
+        if wasClosed is False:
+            try:
+                gatekeeperSocket._sendMuxFrames(packFrame(self.streamId, FRAME_CLOSE))
+            except socket.error:
+                pass
 
+# vim: ts=4 sw=4 expandtab
@@ -2,19 +2,32 @@
 #    Copyright (c) 2015 Timothy Savannah <kata198@gmail.com> LGPL v2.1
 #    See LICENSE for more information, or https://gnu.org/licenses/old-licenses/lgpl-2.1.txt
 ###
+import errno
 import multiprocessing
+import os
 import select
 import signal
 import socket
 import sys
+import time
 import traceback
 
+from .Profiler import SamplingProfiler, DEFAULT_PROFILE_SECONDS, getDefaultProfileDir
+from .RateLimiter import MIN_LIMITER_DELAY, MAX_LIMITER_DELAY
 from .utils import closeSocket
 
 
 DEFAULT_CLIENT_BUFFER_LEN = 4096
 DEFAULT_ENDPOINT_BUFFER_LEN = 4096
 
+# After the client closes its sending side, relay the endpoint's response for at most this many seconds
+HALF_CLOSE_MAX_SECONDS = 60
+
+# Adaptive buffers never grow larger than this, unless the starting buffer length is larger
+ADAPTIVE_MAX_BUFFER_LEN = 256 * 1024
+# Adaptive buffers shrink after this many consecutive reads which used less than a quarter of the buffer
+ADAPTIVE_SHRINK_AFTER = 8
+
 
 class HandlerStop(Exception):
     ''' 
@@ -47,12 +60,45 @@ def handlerFilterDos2Unix(contents):
     return None
     
 
+class AdaptiveBufferLen(object):
+    '''
+        AdaptiveBufferLen - Tracks the recv size for one side of a Handler, based on how full each read is.
+
+        A read which fills the buffer means more data is waiting, so the size doubles (fewer syscalls for bulk streams).
+          Several small reads in a row halve it again, back down to the starting size (interactive traffic).
+    '''
+
+    def __init__(self, minBufferLen, maxBufferLen=ADAPTIVE_MAX_BUFFER_LEN):
+        self.minBufferLen = minBufferLen
+        self.maxBufferLen = max(minBufferLen, maxBufferLen)
+
+        self.bufferLen = minBufferLen
+        self.numSmallReads = 0
+
+    def update(self, numRead, requestedLen):
+        '''
+            update - Record a read of #numRead bytes, when #requestedLen were asked for.
+        '''
+        if numRead >= requestedLen:
+            self.numSmallReads = 0
+            # Only grow if the read was not already cut short (e.x. by a rate limiter)
+            if requestedLen >= self.bufferLen and self.bufferLen < self.maxBufferLen:
+                self.bufferLen = min(self.maxBufferLen, self.bufferLen * 2)
+        elif numRead < self.bufferLen // 4:
+            self.numSmallReads += 1
+            if self.numSmallReads >= ADAPTIVE_SHRINK_AFTER and self.bufferLen > self.minBufferLen:
+                self.bufferLen = max(self.minBufferLen, self.bufferLen // 2)
+                self.numSmallReads = 0
+        else:
+            self.numSmallReads = 0
+
+
 class Handler(multiprocessing.Process):
     '''
         Handler -- represents the handler who handles the in-between of data.
     '''
 
-    def __init__(self, clientSocket, clientAddr, endpointAddr, endpointPort, clientBufferLen=DEFAULT_CLIENT_BUFFER_LEN, endpointBufferLen=DEFAULT_ENDPOINT_BUFFER_LEN):
+    def __init__(self, clientSocket, clientAddr, endpointAddr, endpointPort, clientBufferLen=DEFAULT_CLIENT_BUFFER_LEN, endpointBufferLen=DEFAULT_ENDPOINT_BUFFER_LEN, profileSeconds=DEFAULT_PROFILE_SECONDS, profileDir=None):
         multiprocessing.Process.__init__(self)
 
         self.clientSocket = clientSocket
@@ -68,6 +114,20 @@ class Handler(multiprocessing.Process):
 
         self.fromClientFilters = []
 
+        self.incomingLimiters = []
+        self.outgoingLimiters = []
+
+        self.profileSeconds = profileSeconds or DEFAULT_PROFILE_SECONDS
+        self.profileDir = profileDir or getDefaultProfileDir()
+        self.profiler = None
+        self.initialProfileSeconds = 0
+
+        self.sessionTrace = None
+
+        self.socketOptions = {}
+        self.adaptiveBuffers = False
+
+        self.initialClientData = ''
 
     def addIncomingFilter(self, filterFunc):
         '''
@@ -87,7 +147,119 @@ class Handler(multiprocessing.Process):
         return contents
 
 
+    def addIncomingLimiter(self, limiter):
+        '''
+            addIncomingLimiter - Add a rate limiter which will be applied to data coming from the client.
+
+            @param limiter - A TokenBucket or SharedTokenBucket. Reads from the client will not exceed what every limiter allows.
+        '''
+        self.incomingLimiters.append(limiter)
+
+    def addOutgoingLimiter(self, limiter):
+        '''
+            addOutgoingLimiter - Add a rate limiter which will be applied to data coming from the endpoint, going to the client.
+
+            @see addIncomingLimiter
+        '''
+        self.outgoingLimiters.append(limiter)
+
+    @staticmethod
+    def _getAllowedReadLen(limiters, bufferLen):
+        # Returns 0 until every limiter has at least a quantum available, @see TokenBucket.getQuantum
+        readLen = bufferLen
+        for limiter in limiters:
+            available = limiter.available()
+            if available < limiter.getQuantum(bufferLen):
+                return 0
+            readLen = min(readLen, available)
+        return readLen
+
+    @staticmethod
+    def _getLimiterDelay(limiters, bufferLen):
+        delay = max([limiter.getDelay(limiter.getQuantum(bufferLen)) for limiter in limiters] or [0])
+        return min(MAX_LIMITER_DELAY, max(MIN_LIMITER_DELAY, delay))
+
+    @staticmethod
+    def _consumeLimiters(limiters, numBytes):
+        for limiter in limiters:
+            limiter.consume(numBytes)
+
+    def setSocketOptions(self, socketOptions):
+        '''
+            setSocketOptions - Set options which will be applied to both the client and endpoint sockets.
+
+            @param socketOptions - dict, may contain:
+                tcpNoDelay - bool, TCP_NODELAY
+                keepAlive - bool, SO_KEEPALIVE
+                recvBuffer - int, SO_RCVBUF
+                sendBuffer - int, SO_SNDBUF
+        '''
+        self.socketOptions = socketOptions
+
+    def setAdaptiveBuffers(self, adaptiveBuffers):
+        '''
+            setAdaptiveBuffers - If True, the client and endpoint buffer lengths are used as a starting (and minimum) size,
+              and grow or shrink with the traffic. @see AdaptiveBufferLen
+        '''
+        self.adaptiveBuffers = adaptiveBuffers
+
+    def _applySocketOptions(self, sock):
+        socketOptions = self.socketOptions
+        try:
+            if 'tcpNoDelay' in socketOptions:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(socketOptions['tcpNoDelay']))
+            if 'keepAlive' in socketOptions:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(socketOptions['keepAlive']))
+            if 'recvBuffer' in socketOptions:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socketOptions['recvBuffer'])
+            if 'sendBuffer' in socketOptions:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, socketOptions['sendBuffer'])
+        except socket.error as e:
+            sys.stderr.write('Failed to set socket options %s: %s\n' %(str(socketOptions), str(e)))
+
+    def setInitialClientData(self, initialClientData):
+        '''
+            setInitialClientData - Set data which the client sent right behind its password, before this handler took over the connection.
+              It is relayed to the endpoint as if it were the first data read from the client.
+        '''
+        self.initialClientData = initialClientData
+
+    def setSessionTrace(self, sessionTrace):
+        '''
+            setSessionTrace - Set a SessionTrace which this handler will complete (endpoint connected, first byte) and write out.
+        '''
+        self.sessionTrace = sessionTrace
+
+    def _writeSessionTrace(self):
+        if self.sessionTrace is not None:
+            self.sessionTrace.write()
+            self.sessionTrace = None
+
+    def setInitialProfileSeconds(self, initialProfileSeconds):
+        '''
+            setInitialProfileSeconds - Start profiling for #initialProfileSeconds as soon as this handler runs.
+              Used by the Listener for handlers started while it is already profiling, which would otherwise miss the SIGUSR1.
+        '''
+        self.initialProfileSeconds = initialProfileSeconds
+
+    def startProfiling(self, *args):
+        '''
+            startProfiling - Signal handler (SIGUSR1) which samples this handler for #profileSeconds, writing the result to #profileDir
+        '''
+        self._startProfiler(self.profileSeconds)
+
+    def _startProfiler(self, seconds):
+        if self.profiler is not None and self.profiler.isRunning():
+            return
+        self.profiler = SamplingProfiler(os.path.join(self.profileDir, 'socket-gatekeeper-profile.handler.%d.%d.txt' %(os.getpid(), int(time.time()))))
+        self.profiler.start(seconds)
+
     def _closeConnectionsAndExit(self, *args, **kwargs):
+        if self.sessionTrace is not None:
+            self.sessionTrace.mark('closed')
+            self._writeSessionTrace()
+        if self.profiler is not None and self.profiler.isRunning():
+            self.profiler.stop()
         closeSocket(self.clientSocket)
         closeSocket(self.endpointSocket)
         sys.exit(0)
@@ -97,23 +269,90 @@ class Handler(multiprocessing.Process):
         signal.signal(signal.SIGTERM, self._closeConnectionsAndExit)
         signal.signal(signal.SIGINT, self._closeConnectionsAndExit)
 
+        # Restart interrupted sends/recvs. select is never restarted, so EINTR is handled below.
+        signal.signal(signal.SIGUSR1, self.startProfiling)
+        signal.siginterrupt(signal.SIGUSR1, False)
+
+        if self.initialProfileSeconds:
+            self._startProfiler(self.initialProfileSeconds)
+
         clientSocket = self.clientSocket
 
+        if self.socketOptions:
+            self._applySocketOptions(clientSocket)
+
         try:
             endpointSocket = self.endpointSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.socketOptions:
+                # Before connect, so SO_RCVBUF can affect the window negotiated with the endpoint
+                self._applySocketOptions(endpointSocket)
             endpointSocket.connect( (self.endpointAddr, self.endpointPort) )
         except:
             self.clientSocket.send('Error: unable to connect to endpoint.\n')
             self._closeConnectionsAndExit()
             return
 
+        if self.sessionTrace is not None:
+            self.sessionTrace.mark('endpointConnected')
+
         clientBufferLen = self.clientBufferLen
         endpointBufferLen = self.endpointBufferLen
 
+        incomingLimiters = self.incomingLimiters
+        outgoingLimiters = self.outgoingLimiters
+
+        if self.adaptiveBuffers is True:
+            clientAdaptive = AdaptiveBufferLen(clientBufferLen)
+            endpointAdaptive = AdaptiveBufferLen(endpointBufferLen)
+        else:
+            clientAdaptive = endpointAdaptive = None
+
         dataToClient = ''
         dataFromClient = ''
+
+        if self.initialClientData:
+            if incomingLimiters:
+                self._consumeLimiters(incomingLimiters, len(self.initialClientData))
+            try:
+                dataFromClient = self._runIncomingFilters(self.initialClientData)
+            except HandlerStop:
+                self._closeConnectionsAndExit()
+                return
+            except Exception as e:
+                sys.stderr.write('Exception filtering client data: %s\n' %(str(e,)))
+                sys.stderr.write(traceback.format_exc(sys.exc_info()) + '\n')
+                dataFromClient = self.initialClientData
+
+        # When the client shuts down its sending side, pass that on to the endpoint and keep relaying its response.
+        #  When the endpoint closes, finish sending what it sent to the client, then close both.
+        clientClosed = False
+        endpointShutdown = False
+        endpointClosed = False
+        halfCloseDeadline = None
+
         while True:
+            if clientAdaptive is not None:
+                clientBufferLen = clientAdaptive.bufferLen
+                endpointBufferLen = endpointAdaptive.bufferLen
+
+            waitingToRead = []
             waitingToWrite = []
+            selectTimeout = .2
+
+            # When a rate limit is exhausted, stop reading from that side (letting TCP push back on the sender) until tokens are available
+            if clientClosed is False:
+                clientReadLen = self._getAllowedReadLen(incomingLimiters, clientBufferLen)
+                if clientReadLen > 0:
+                    waitingToRead.append(clientSocket)
+                else:
+                    selectTimeout = min(selectTimeout, self._getLimiterDelay(incomingLimiters, clientBufferLen))
+
+            if endpointClosed is False:
+                endpointReadLen = self._getAllowedReadLen(outgoingLimiters, endpointBufferLen)
+                if endpointReadLen > 0:
+                    waitingToRead.append(endpointSocket)
+                else:
+                    selectTimeout = min(selectTimeout, self._getLimiterDelay(outgoingLimiters, endpointBufferLen))
 
             if dataToClient:
                 waitingToWrite.append(clientSocket)
@@ -121,7 +360,12 @@ class Handler(multiprocessing.Process):
                 waitingToWrite.append(endpointSocket)
 
 
-            (hasDataForRead, readyForWrite, hasError) = select.select( [clientSocket, endpointSocket], waitingToWrite, [clientSocket, endpointSocket], .2)
+            try:
+                (hasDataForRead, readyForWrite, hasError) = select.select( waitingToRead, waitingToWrite, [clientSocket, endpointSocket], selectTimeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
 
             if hasError:
                 break
@@ -129,36 +373,73 @@ class Handler(multiprocessing.Process):
             # TODO: Possibly loop on reading here until the socket is empty with select. May work better with filters.
             #   For now, stick with what has been extensively tested.
             if clientSocket in hasDataForRead:
-                nextData = clientSocket.recv(clientBufferLen)
-                if not nextData:
-                    break
                 try:
-                    nextData = self._runIncomingFilters(nextData)
-                except HandlerStop:
-                    self._closeConnectionsAndExit()
-                    return
-                except Exception as e:
-                    sys.stderr.write('Exception filtering client data: %s\n' %(str(e,)))
-                    sys.stderr.write(traceback.format_exc(sys.exc_info()) + '\n')
-
-                dataFromClient += nextData
+                    nextData = clientSocket.recv(clientReadLen)
+                except socket.error:
+                    break
+                if not nextData:
+                    clientClosed = True
+                    halfCloseDeadline = time.time() + HALF_CLOSE_MAX_SECONDS
+                else:
+                    if incomingLimiters:
+                        self._consumeLimiters(incomingLimiters, len(nextData))
+                    if clientAdaptive is not None:
+                        clientAdaptive.update(len(nextData), clientReadLen)
+                    try:
+                        nextData = self._runIncomingFilters(nextData)
+                    except HandlerStop:
+                        self._closeConnectionsAndExit()
+                        return
+                    except Exception as e:
+                        sys.stderr.write('Exception filtering client data: %s\n' %(str(e,)))
+                        sys.stderr.write(traceback.format_exc(sys.exc_info()) + '\n')
+
+                    dataFromClient += nextData
 
             if endpointSocket in hasDataForRead:
-                nextData = endpointSocket.recv(endpointBufferLen)
-                if not nextData:
+                try:
+                    nextData = endpointSocket.recv(endpointReadLen)
+                except socket.error:
                     break
-                dataToClient += nextData
-
-            if endpointSocket in readyForWrite:
-                while dataFromClient:
-                    endpointSocket.send(dataFromClient[:endpointBufferLen])
-                    dataFromClient = dataFromClient[endpointBufferLen:]
+                if not nextData:
+                    endpointClosed = True
+                else:
+                    if outgoingLimiters:
+                        self._consumeLimiters(outgoingLimiters, len(nextData))
+                    if endpointAdaptive is not None:
+                        endpointAdaptive.update(len(nextData), endpointReadLen)
+                    dataToClient += nextData
+
+            if self.sessionTrace is not None and (dataFromClient or dataToClient):
+                self.sessionTrace.mark('firstByte')
+                self._writeSessionTrace()
+
+            # Either side may have gone away completely (e.x. a client which closed rather than half-closed)
+            try:
+                if endpointSocket in readyForWrite:
+                    while dataFromClient:
+                        endpointSocket.sendall(dataFromClient[:endpointBufferLen])
+                        dataFromClient = dataFromClient[endpointBufferLen:]
+
+                if clientSocket in readyForWrite:
+                    while dataToClient:
+                        clientSocket.sendall(dataToClient[:clientBufferLen])
+                        dataToClient = dataToClient[clientBufferLen:]
+            except socket.error:
+                break
 
-            if clientSocket in readyForWrite:
-                while dataToClient:
-                    clientSocket.send(dataToClient[:clientBufferLen])
-                    dataToClient = dataToClient[clientBufferLen:]
+            if endpointClosed is True and not dataToClient:
+                break
 
+            if clientClosed is True:
+                if endpointShutdown is False and not dataFromClient:
+                    try:
+                        endpointSocket.shutdown(socket.SHUT_WR)
+                    except socket.error:
+                        break
+                    endpointShutdown = True
+                if time.time() > halfCloseDeadline:
+                    break
 
         self._closeConnectionsAndExit()
 
@@ -3,6 +3,7 @@
 #    See LICENSE for more information, or https://gnu.org/licenses/old-licenses/lgpl-2.1.txt
 ###
 
+import errno
 import multiprocessing
 import os
 import socket
@@ -16,12 +17,24 @@ from Crypto.PublicKey import RSA
 from Crypto import Random
 
 from .Handler import Handler
+from .MultiplexHandler import MultiplexHandler
+from .Profiler import SamplingProfiler, SessionTrace, markTrace, DEFAULT_PROFILE_SECONDS, getDefaultProfileDir
+from .RateLimiter import TokenBucket, SharedTokenBucket
 from .utils import closeSocket
 
 
 
 CHILD_JOIN_SECONDS = .1
 
+# The client ends its encrypted password with this
+PASSWORD_TERMINATOR = '\r\n'
+
+# Give up on a client which has not completed the handshake in this many seconds
+HANDSHAKE_TIMEOUT_SECONDS = 30
+
+# Mapping options which are passed through to Handler.setSocketOptions
+SOCKET_OPTION_NAMES = ('tcpNoDelay', 'keepAlive', 'recvBuffer', 'sendBuffer')
+
 class Listener(multiprocessing.Process):
     '''
         Listener - The process which listens on the incoming port for connections, verifies their authentication,
@@ -29,14 +42,18 @@ class Listener(multiprocessing.Process):
     '''
 
 
-    def __init__(self, localAddr, localPort, mappings, overrideClientBufferLen=None, overrideEndpointBufferLen=None):
+    def __init__(self, localAddr, localPort, mappings, overrideClientBufferLen=None, overrideEndpointBufferLen=None, profileSeconds=DEFAULT_PROFILE_SECONDS, profileDir=None, traceSessions=False):
         '''
             localAddr - Local Address to bind
             localPort - Local port to bind
-            mappings - Dictionary of sha256 password to an address and port
+            mappings - Dictionary of sha256 password to an address, port, and options
 
             overrideClientBufferLen - Bytes - Provide an integer to override the buffer size used in transactions to/from the client (incoming connection)
             overrideEndpointBufferLen - Bytes - Provide an integer to override the buffer size used in transactions to/from the endpoint (destination)
+
+            profileSeconds - Number of seconds to profile for upon SIGUSR1
+            profileDir - Directory where profiles and session traces are written. Defaults to the system temp directory.
+            traceSessions - If True, write a timing trace of each session accepted while profiling is active
         '''
         multiprocessing.Process.__init__(self)
         self.localAddr = localAddr
@@ -44,6 +61,13 @@ class Listener(multiprocessing.Process):
 
         self.mappings = mappings
 
+        # Limiters shared by every session on a mapping. Must be created before Handlers fork. sha256 password -> (incoming, outgoing)
+        self.mappingLimiters = {}
+        for (passwordSummed, mapping) in mappings.items():
+            mappingRate = mapping.get('options', {}).get('mappingRate', None)
+            if mappingRate:
+                self.mappingLimiters[passwordSummed] = ( SharedTokenBucket(mappingRate), SharedTokenBucket(mappingRate) )
+
         self.myWorkers = []
 
 
@@ -58,6 +82,11 @@ class Listener(multiprocessing.Process):
         self.overrideClientBufferLen = overrideClientBufferLen or None
         self.overrideEndpointBufferLen = overrideEndpointBufferLen or None
 
+        self.profileSeconds = profileSeconds or DEFAULT_PROFILE_SECONDS
+        self.profileDir = profileDir or getDefaultProfileDir()
+        self.traceSessions = traceSessions
+        self.profiler = None
+
         self.rsaKey = None # Call _initRSA after fork
 
     def _initRSA(self):
@@ -167,23 +196,98 @@ class Listener(multiprocessing.Process):
 
 
 
-    def handleConnection(self, clientConnection, clientAddr):
+    def startProfiling(self, *args):
+        '''
+            startProfiling - the signal handler (SIGUSR1) which profiles this listener and all of its workers for #profileSeconds.
+
+              Output is written to #profileDir, one file per process.
+        '''
+        if self.profiler is not None and self.profiler.isRunning():
+            return
+
+        sys.stderr.write("Listener on %s:%d profiling for %d seconds. Writing to %s\n" %(self.localAddr, self.localPort, self.profileSeconds, self.profileDir))
+
+        self.profiler = SamplingProfiler(os.path.join(self.profileDir, 'socket-gatekeeper-profile.listener.%d.%d.txt' %(os.getpid(), int(time.time()))))
+        self.profiler.start(self.profileSeconds)
+
+        for worker in self.myWorkers[:]:
+            try:
+                os.kill(worker.pid, signal.SIGUSR1)
+            except:
+                pass
+
+    def _isProfiling(self):
+        return bool(self.profiler is not None and self.profiler.isRunning())
+
+    def _recvPasswordLine(self, clientConnection):
+        '''
+            _recvPasswordLine - Read the encrypted password line from the client.
+
+              Clients may send data right behind the password (e.x. socket-gatekeeper-connect --pipe, or multiplex frames),
+              so only read through the terminator, and return anything after it to be passed on to the Handler.
+
+              The encrypted password is binary and may itself contain the terminator, but is never longer than the key.
+              GatekeeperSocket pads it to exactly the key length. Otherwise (older clients), the password ends at the
+              last terminator which starts within a key length.
+
+            @return - tuple (encryptedPassword, extraData). Raises ValueError if the client does not send a valid line.
+        '''
+        keyLen = (self.rsaKey.size() + 8) // 8
+        lineLen = keyLen + len(PASSWORD_TERMINATOR)
+
+        data = ''
+        while len(data) < lineLen and not data.endswith(PASSWORD_TERMINATOR):
+            nextData = clientConnection.recv(4096)
+            if not nextData:
+                raise ValueError('Connection closed during handshake.')
+            data += nextData
+
+        if data[keyLen:lineLen] == PASSWORD_TERMINATOR:
+            terminatorIdx = keyLen
+        else:
+            terminatorIdx = data.rfind(PASSWORD_TERMINATOR, 0, lineLen)
+        if terminatorIdx == -1:
+            raise ValueError('Password line was not terminated.')
+
+        return (data[:terminatorIdx], data[terminatorIdx + len(PASSWORD_TERMINATOR):])
+
+    def handleConnection(self, clientConnection, clientAddr, acceptTime=None):
         '''
             handleConnection - Handles an incoming connection. Checks auth and starts a Handler process.
 
             @param clientConnection - Socket
             @param clientAddr - Address
+            @param acceptTime - time.time() when the connection was accepted, for session traces
         '''
 
-        # First, send our public key for them to encrypt password
-        clientConnection.send(self.rsaKey.publickey().exportKey())
+        if self.traceSessions is True and self._isProfiling():
+            sessionTrace = SessionTrace(clientAddr, os.path.join(self.profileDir, 'socket-gatekeeper-trace.%d.txt' %(os.getpid(),)), acceptTime)
+        else:
+            sessionTrace = None
+
+        try:
+            clientConnection.settimeout(HANDSHAKE_TIMEOUT_SECONDS)
+
+            # First, send our public key for them to encrypt password
+            clientConnection.send(self.rsaKey.publickey().exportKey())
+            markTrace(sessionTrace, 'keySent')
+
+            (encryptedPassword, extraData) = self._recvPasswordLine(clientConnection)
+            markTrace(sessionTrace, 'passwordReceived')
 
-        # Accept up to 4K of encrypted data and don't use an intermediate variable before decrpying and sha256 summing
-        passwordSummed = sha256(self.rsaKey.decrypt(clientConnection.recv(4096).strip())).hexdigest()
+            # Don't use an intermediate variable between decrypting and sha256 summing
+            passwordSummed = sha256(markTrace(sessionTrace, 'decrypted', self.rsaKey.decrypt(encryptedPassword))).hexdigest()
 
+            clientConnection.settimeout(None)
+        except Exception:
+            # Timed out, disconnected, or sent garbage. Handled as a bad password below.
+            passwordSummed = None
 
         if passwordSummed not in self.mappings:
             # No match, terminate connection
+            if sessionTrace is not None:
+                sessionTrace.mark('rejected')
+                sessionTrace.write()
             closeSocket(clientConnection)
             self.tmpConnections.remove(clientConnection)
             return
@@ -192,11 +296,36 @@ class Listener(multiprocessing.Process):
         workerInfo = self.mappings[passwordSummed]
 
         # Create the worker
-        worker = Handler(clientConnection, clientAddr, workerInfo['addr'], workerInfo['port'], self.overrideClientBufferLen, self.overrideEndpointBufferLen)
+        workerOptions = workerInfo.get('options', {})
+        if workerOptions.get('multiplex', False) is True:
+            handlerClass = MultiplexHandler
+        else:
+            handlerClass = Handler
+
+        worker = handlerClass(clientConnection, clientAddr, workerInfo['addr'], workerInfo['port'],
+            workerOptions.get('clientBufferLen', self.overrideClientBufferLen), workerOptions.get('endpointBufferLen', self.overrideEndpointBufferLen),
+            self.profileSeconds, self.profileDir
+        )
+
+        if sessionTrace is not None:
+            worker.setSessionTrace(sessionTrace)
+
+        if extraData:
+            worker.setInitialClientData(extraData)
+
+        # Apply per-mapping and per-session rate limits
+        self.applyLimitersToHandler(worker, passwordSummed, workerInfo)
+
+        # Apply per-mapping socket options and buffer mode
+        self.applySocketOptionsToHandler(worker, passwordSummed, workerInfo)
 
         # Apply any filters to worker object
         self.applyFiltersToHandler(worker, passwordSummed, workerInfo)
 
+        # Workers started while profiling did not get the SIGUSR1, so have them profile for the rest of the run
+        if self._isProfiling():
+            worker.setInitialProfileSeconds(self.profiler.getRemainingSeconds())
+
         # Start worker, and update accounting.
         worker.start()
         self.tmpConnections.remove(clientConnection)
@@ -211,6 +340,9 @@ class Listener(multiprocessing.Process):
         # Add handler for shutting down
         signal.signal(signal.SIGTERM, self.closeWorkers)
 
+        # Add handler for profiling
+        signal.signal(signal.SIGUSR1, self.startProfiling)
+
         # Init RSA engine
         self._initRSA()
 
@@ -241,9 +373,14 @@ class Listener(multiprocessing.Process):
             while self.keepGoing is True:
                 try:
                     (clientConnection, clientAddr) = listenSocket.accept()
+                    acceptTime = time.time()
                     self.clientConnection = clientConnection
                 except:
                     if self.keepGoing is True:
+                        exc = sys.exc_info()[1]
+                        if isinstance(exc, socket.error) and exc.args and exc.args[0] == errno.EINTR:
+                            # Interrupted by a signal (e.x. SIGUSR1 to profile), keep going
+                            continue
                         sys.stderr.write('Cannot bind to %s:%s\n' %(self.localAddr, self.localPort))
                         time.sleep(.1) # Something happened, wait a bit but only if we are to continue
                         continue
@@ -255,7 +392,7 @@ class Listener(multiprocessing.Process):
                 self.tmpConnections.append(self.clientConnection)
 
                 # Pass off the connecting and validation to a thread
-                connectThread = threading.Thread(target=self.handleConnection, args=(clientConnection, clientAddr))
+                connectThread = threading.Thread(target=self.handleConnection, args=(clientConnection, clientAddr, acceptTime))
                 connectThread.start()
 
                 # Keep accounting on connect thread. This will be removed from the list at the end of handleConnection
@@ -267,6 +404,34 @@ class Listener(multiprocessing.Process):
         sys.exit(0)
 
 
+    def applyLimitersToHandler(self, handler, shaPass, mapping):
+        '''
+            applyLimitersToHandler - Applies the rate limits defined by the "mappingRate" and "sessionRate" options of a mapping.
+        '''
+        if shaPass in self.mappingLimiters:
+            (incomingLimiter, outgoingLimiter) = self.mappingLimiters[shaPass]
+            handler.addIncomingLimiter(incomingLimiter)
+            handler.addOutgoingLimiter(outgoingLimiter)
+
+        sessionRate = mapping.get('options', {}).get('sessionRate', None)
+        if sessionRate:
+            handler.addIncomingLimiter(TokenBucket(sessionRate))
+            handler.addOutgoingLimiter(TokenBucket(sessionRate))
+
+    def applySocketOptionsToHandler(self, handler, shaPass, mapping):
+        '''
+            applySocketOptionsToHandler - Applies the socket options (tcpNoDelay, keepAlive, recvBuffer, sendBuffer)
+              and the "adaptiveBuffers" option of a mapping.
+        '''
+        options = mapping.get('options', {})
+
+        socketOptions = dict( [ (name, options[name]) for name in SOCKET_OPTION_NAMES if name in options ] )
+        if socketOptions:
+            handler.setSocketOptions(socketOptions)
+
+        if options.get('adaptiveBuffers', False) is True:
+            handler.setAdaptiveBuffers(True)
+
     def applyFiltersToHandler(self, handler, shaPass, mapping):
         '''
             applyFiltersToHandler - callback function used to apply filters to the handler. 
@@ -5,8 +5,28 @@
 
 import re
 
+from .RateLimiter import parseRate
+from .utils import parseBool, parseSize
+
 COMMENT_RE = re.compile('[#].*$')
-MAPPING_RE = re.compile("^(?P<password>[a-fA-F0-9]+)[ ]*[=][ ]*(?P<addr>[^:]+)[\:](?P<port>.+)$")
+MAPPING_RE = re.compile("^(?P<password>[a-fA-F0-9]+)[ ]*[=][ ]*(?P<addr>[^:]+)[\:](?P<port>[^ ]+)(?P<options>.*)$")
+
+# Options which may follow addr:port on a mapping line, as name=value. Maps the name to the function which parses the value.
+MAPPING_OPTIONS = {
+    'mappingRate' : parseRate, # Bytes per second, per direction, shared by all sessions on this mapping
+    'sessionRate' : parseRate, # Bytes per second, per direction, for each session on this mapping
+
+    'clientBufferLen'   : parseSize, # Overrides --client-buffer-len for this mapping
+    'endpointBufferLen' : parseSize, # Overrides --endpoint-buffer-len for this mapping
+    'adaptiveBuffers'   : parseBool, # Grow/shrink the recv sizes based on how full each read is
+
+    'tcpNoDelay' : parseBool, # TCP_NODELAY on the client and endpoint sockets
+    'keepAlive'  : parseBool, # SO_KEEPALIVE on the client and endpoint sockets
+    'recvBuffer' : parseSize, # SO_RCVBUF on the client and endpoint sockets
+    'sendBuffer' : parseSize, # SO_SNDBUF on the client and endpoint sockets
+
+    'multiplex' : parseBool, # Carry many endpoint streams over each client connection. @see Multiplex
+}
 
 class ParseMappingException(ValueError):
     '''
@@ -21,12 +41,17 @@ class MappingsParser(object):
 
         Format should be:
 
-        sha256sum = addr:port
+        sha256sum = addr:port [option=value ...]
 
         ex:
 
         edeaaff3f1774ad2888673770c6d64097e391bc362d7d6fb34982ddf0efd18cb = 0.0.0.0:80
 
+        edeaaff3f1774ad2888673770c6d64097e391bc362d7d6fb34982ddf0efd18cb = 0.0.0.0:80 mappingRate=10M sessionRate=2M
+
+        edeaaff3f1774ad2888673770c6d64097e391bc362d7d6fb34982ddf0efd18cb = 0.0.0.0:22 tcpNoDelay=yes keepAlive=yes
+
+        @see MAPPING_OPTIONS for the available options. Parsed options are placed in the "options" dict of each mapping.
     '''
 
     def __init__(self, contents):
@@ -70,20 +95,36 @@ class MappingsParser(object):
                 raise ParseMappingException('Cannot parse line: "%s". Must be in format sha256sum=addr:port ' %(line,))
             groupDict = matchObj.groupdict()
 
-            (password, addr, port) = (groupDict['password'], groupDict['addr'], groupDict['port'])
+            (password, addr, port, options) = (groupDict['password'], groupDict['addr'], groupDict['port'], groupDict['options'])
             if password in ret:
                 raise ParseMappingException('Password hash "%s" defined more than once. A password can only corropsond to a single mapping.' %(password,))
 
             if port.isdigit() is False:
                 raise ParseMappingException('Port "%s" must be an integer.' %(port, ) )
 
-            ret[password] = { 'addr' : addr, 'port' : port }
+            ret[password] = { 'addr' : addr, 'port' : port, 'options' : self._parseOptions(options) }
 
         self.cachedMapping = ret
 
         return ret
             
 
+    @staticmethod
+    def _parseOptions(options):
+        ret = {}
+        for option in options.split():
+            if '=' not in option:
+                raise ParseMappingException('Cannot parse option: "%s". Must be in format name=value' %(option,))
+            (name, value) = option.split('=', 1)
+            if name not in MAPPING_OPTIONS:
+                raise ParseMappingException('Unknown option "%s". Valid options are: %s' %(name, ', '.join(sorted(MAPPING_OPTIONS.keys()))))
+            try:
+                ret[name] = MAPPING_OPTIONS[name](value)
+            except ValueError as e:
+                raise ParseMappingException('Invalid value for option "%s": %s' %(name, str(e)))
+        return ret
+
+
 class MappingsFileParser(MappingsParser):
     '''
         Parse mapping data from a file.
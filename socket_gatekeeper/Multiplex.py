@@ -0,0 +1,110 @@
+###
+#    Copyright (c) 2015 Timothy Savannah <kata198@gmail.com> LGPL v2.1
+#    See LICENSE for more information, or https://gnu.org/licenses/old-licenses/lgpl-2.1.txt
+###
+'''
+    Multiplex - The framed protocol used to carry several streams over a single authenticated connection.
+
+    Used on mappings with the "multiplex" option. After authentication, everything in both directions is a frame:
+
+        stream id   - 4 bytes, unsigned, network order. Chosen by the client, starting at 1. Never reused on a connection.
+        frame type  - 1 byte, one of the FRAME_* constants
+        length      - 4 bytes, unsigned, network order. Length of the payload which follows, at most MAX_FRAME_PAYLOAD
+
+    Frame types:
+
+        FRAME_OPEN   - client -> server, open a new stream to the endpoint. No payload.
+        FRAME_OPENED - server -> client, the endpoint connection for this stream is established. No payload.
+        FRAME_DATA   - either direction, payload is stream data.
+        FRAME_WINDOW - either direction, payload is a 4 byte unsigned increment to the sender's window for this stream.
+        FRAME_CLOSE  - either direction, the stream is closed. Payload is an optional error message.
+
+    Flow control: each side may have at most INITIAL_WINDOW bytes of DATA outstanding per stream.
+      The receiver grants more with a FRAME_WINDOW once the data has been delivered (to the endpoint, or to the application).
+'''
+
+import struct
+
+
+FRAME_OPEN = 1
+FRAME_OPENED = 2
+FRAME_DATA = 3
+FRAME_WINDOW = 4
+FRAME_CLOSE = 5
+
+FRAME_HEADER = struct.Struct('!IBI')
+FRAME_HEADER_LEN = FRAME_HEADER.size
+
+WINDOW_STRUCT = struct.Struct('!I')
+
+MAX_FRAME_PAYLOAD = 65536
+
+INITIAL_WINDOW = 262144
+
+# Send a window update once this many bytes have been delivered, rather than for every read
+WINDOW_UPDATE_THRESHOLD = INITIAL_WINDOW // 4
+
+
+class MultiplexProtocolError(ValueError):
+    '''
+        MultiplexProtocolError - Raised when the other side sends something which is not valid in the multiplex protocol.
+    '''
+    pass
+
+
+def packFrame(streamId, frameType, payload=''):
+    '''
+        packFrame - Returns the bytes of a frame.
+    '''
+    return FRAME_HEADER.pack(streamId, frameType, len(payload)) + payload
+
+def packDataFrames(streamId, data):
+    '''
+        packDataFrames - Returns the bytes of as many FRAME_DATA frames as are needed to carry #data.
+    '''
+    return ''.join([packFrame(streamId, FRAME_DATA, data[i:i + MAX_FRAME_PAYLOAD]) for i in range(0, len(data), MAX_FRAME_PAYLOAD)])
+
+def packWindowFrame(streamId, increment):
+    return packFrame(streamId, FRAME_WINDOW, WINDOW_STRUCT.pack(increment))
+
+def unpackWindow(payload):
+    if len(payload) != WINDOW_STRUCT.size:
+        raise MultiplexProtocolError('Window frame payload must be %d bytes, got %d.' %(WINDOW_STRUCT.size, len(payload)))
+    return WINDOW_STRUCT.unpack(payload)[0]
+
+
+class FrameReader(object):
+    '''
+        FrameReader - Accumulates data read from a connection and splits it into frames.
+    '''
+
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, data):
+        '''
+            feed - Add data read from the connection.
+
+            @return - list of (streamId, frameType, payload) for every frame which is now complete.
+        '''
+        buf = self.buffer + data
+        frames = []
+        offset = 0
+        bufLen = len(buf)
+        while bufLen - offset >= FRAME_HEADER_LEN:
+            (streamId, frameType, length) = FRAME_HEADER.unpack_from(buf, offset)
+            if length > MAX_FRAME_PAYLOAD:
+                raise MultiplexProtocolError('Frame payload of %d bytes exceeds the maximum of %d.' %(length, MAX_FRAME_PAYLOAD))
+            if frameType < FRAME_OPEN or frameType > FRAME_CLOSE:
+                raise MultiplexProtocolError('Unknown frame type %d.' %(frameType,))
+            frameEnd = offset + FRAME_HEADER_LEN + length
+            if frameEnd > bufLen:
+                break
+            frames.append( (streamId, frameType, buf[offset + FRAME_HEADER_LEN:frameEnd]) )
+            offset = frameEnd
+
+        self.buffer = buf[offset:]
+        return frames
+
+
+# vim: ts=4 sw=4 expandtab
@@ -0,0 +1,408 @@
+###
+#    Copyright (c) 2015 Timothy Savannah <kata198@gmail.com> LGPL v2.1
+#    See LICENSE for more information, or https://gnu.org/licenses/old-licenses/lgpl-2.1.txt
+###
+
+import errno
+import math
+import os
+import select
+import signal
+import socket
+import sys
+import traceback
+
+from .Handler import Handler, HandlerStop, AdaptiveBufferLen
+from .Multiplex import (FRAME_OPEN, FRAME_OPENED, FRAME_DATA, FRAME_WINDOW, FRAME_CLOSE, INITIAL_WINDOW, WINDOW_UPDATE_THRESHOLD,
+    MultiplexProtocolError, FrameReader, packFrame, packDataFrames, packWindowFrame, unpackWindow)
+from .utils import closeSocket
+
+
+# Maximum number of streams open at once on a single connection
+MAX_STREAMS = 1024
+
+# Stop reading from the client and endpoints while this much is waiting to be sent to the client
+MAX_PENDING_TO_CLIENT = 1024 * 1024
+
+WOULD_BLOCK_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Every stream has its own endpoint socket, so use poll rather than select, which cannot watch fds above FD_SETSIZE (1024)
+POLL_READ_EVENTS = select.POLLIN | select.POLLHUP | select.POLLERR
+POLL_WRITE_EVENTS = select.POLLOUT | select.POLLHUP | select.POLLERR
+
+
+class MultiplexStream(object):
+    '''
+        MultiplexStream - One endpoint connection carried over a MultiplexHandler's client connection.
+    '''
+
+    def __init__(self, streamId, endpointSocket, endpointAdaptive=None):
+        self.streamId = streamId
+        self.endpointSocket = endpointSocket
+        # AdaptiveBufferLen for reads from this stream's endpoint, if the mapping has "adaptiveBuffers"
+        self.endpointAdaptive = endpointAdaptive
+
+        self.connected = False
+        # Set when the client closes the stream. The endpoint is closed once toEndpoint has been flushed.
+        self.closing = False
+
+        self.toEndpoint = ''
+        # Bytes received from the client which have not yet been credited back with a window update
+        self.uncredited = 0
+
+        # Bytes which may still be sent to the client before it grants more window
+        self.sendWindow = INITIAL_WINDOW
+
+
+class MultiplexHandler(Handler):
+    '''
+        MultiplexHandler - A Handler which carries many independent endpoint streams over one authenticated client connection.
+
+        Used for mappings with the "multiplex" option. @see Multiplex for the protocol, and GatekeeperSocket.openStream for the client side.
+
+        Filters and rate limiters apply as they do to a Handler. Filters see the data of each frame, and raising HandlerStop closes only that stream.
+          With "adaptiveBuffers", the client connection and each stream's endpoint connection get their own AdaptiveBufferLen.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        Handler.__init__(self, *args, **kwargs)
+
+        self.streams = {}
+        self.lastStreamId = 0
+
+        self.toClient = ''
+
+        self.anyStreamConnected = False
+
+    def _closeConnectionsAndExit(self, *args, **kwargs):
+        for stream in list(self.streams.values()):
+            closeSocket(stream.endpointSocket)
+        Handler._closeConnectionsAndExit(self, *args, **kwargs)
+
+    def _queueToClient(self, data):
+        self.toClient += data
+
+    def _flushToClient(self):
+        try:
+            numSent = self.clientSocket.send(self.toClient)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK_ERRNOS:
+                return
+            raise
+        self.toClient = self.toClient[numSent:]
+
+    def _removeStream(self, stream, errorMessage=None):
+        '''
+            _removeStream - Close a stream's endpoint and forget it. If #errorMessage is not None, the client is sent a FRAME_CLOSE with it.
+        '''
+        closeSocket(stream.endpointSocket)
+        self.streams.pop(stream.streamId, None)
+        if errorMessage is not None:
+            self._queueToClient(packFrame(stream.streamId, FRAME_CLOSE, errorMessage))
+
+    def _openStream(self, streamId):
+        if streamId <= self.lastStreamId:
+            raise MultiplexProtocolError('Stream id %d was not greater than the last stream id %d.' %(streamId, self.lastStreamId))
+        self.lastStreamId = streamId
+
+        if len(self.streams) >= MAX_STREAMS:
+            self._queueToClient(packFrame(streamId, FRAME_CLOSE, 'Too many streams.'))
+            return
+
+        # Failures here (e.x. out of file descriptors, or the endpoint host does not resolve) refuse only this stream
+        try:
+            endpointSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        except socket.error as e:
+            self._queueToClient(packFrame(streamId, FRAME_CLOSE, 'Unable to connect to endpoint: %s' %(str(e),)))
+            return
+
+        if self.socketOptions:
+            self._applySocketOptions(endpointSocket)
+        endpointSocket.setblocking(0)
+
+        if self.adaptiveBuffers is True:
+            endpointAdaptive = AdaptiveBufferLen(self.endpointBufferLen)
+        else:
+            endpointAdaptive = None
+
+        stream = MultiplexStream(streamId, endpointSocket, endpointAdaptive)
+        self.streams[streamId] = stream
+
+        # Completion (or failure) of the connect is picked up when the socket becomes writable
+        try:
+            err = endpointSocket.connect_ex( (self.endpointAddr, self.endpointPort) )
+        except socket.error as e:
+            self._removeStream(stream, 'Unable to connect to endpoint: %s' %(str(e),))
+            return
+        if err not in (0, errno.EINPROGRESS):
+            self._removeStream(stream, 'Unable to connect to endpoint: %s' %(os.strerror(err),))
+
+    def _finishConnect(self, stream):
+        err = stream.endpointSocket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            self._removeStream(stream, 'Unable to connect to endpoint: %s' %(os.strerror(err),))
+            return
+
+        stream.connected = True
+        self._queueToClient(packFrame(stream.streamId, FRAME_OPENED))
+
+        if self.anyStreamConnected is False:
+            self.anyStreamConnected = True
+            if self.sessionTrace is not None:
+                self.sessionTrace.mark('endpointConnected')
+
+    def _markFirstByte(self):
+        if self.sessionTrace is not None:
+            self.sessionTrace.mark('firstByte')
+            self._writeSessionTrace()
+
+    def _handleClientFrame(self, streamId, frameType, payload):
+        if frameType == FRAME_OPEN:
+            self._openStream(streamId)
+            return
+
+        if frameType == FRAME_OPENED:
+            raise MultiplexProtocolError('Client sent an OPENED frame.')
+
+        stream = self.streams.get(streamId, None)
+        if stream is None:
+            # Already closed on our side, and the client had not seen the close yet.
+            return
+
+        if frameType == FRAME_DATA:
+            if stream.closing:
+                return
+            stream.uncredited += len(payload)
+            if stream.uncredited > INITIAL_WINDOW:
+                raise MultiplexProtocolError('Client exceeded the window on stream %d.' %(streamId,))
+            try:
+                payload = self._runIncomingFilters(payload)
+            except HandlerStop:
+                self._removeStream(stream, '')
+                return
+            except Exception as e:
+                sys.stderr.write('Exception filtering client data: %s\n' %(str(e,)))
+                sys.stderr.write(traceback.format_exc(sys.exc_info()) + '\n')
+            stream.toEndpoint += payload
+            self._markFirstByte()
+
+        elif frameType == FRAME_WINDOW:
+            stream.sendWindow += unpackWindow(payload)
+
+        elif frameType == FRAME_CLOSE:
+            stream.closing = True
+            if not stream.connected or not stream.toEndpoint:
+                self._removeStream(stream)
+
+    def _flushToEndpoint(self, stream):
+        try:
+            numSent = stream.endpointSocket.send(stream.toEndpoint)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK_ERRNOS:
+                return
+            self._removeStream(stream, 'Endpoint error: %s' %(str(e),))
+            return
+        stream.toEndpoint = stream.toEndpoint[numSent:]
+
+        if stream.closing and not stream.toEndpoint:
+            self._removeStream(stream)
+            return
+
+        # Credit what has been delivered. Filters may change the length of the data, so when the buffer empties, credit everything.
+        if stream.toEndpoint:
+            toCredit = stream.uncredited - len(stream.toEndpoint)
+            if toCredit < WINDOW_UPDATE_THRESHOLD:
+                return
+        else:
+            toCredit = stream.uncredited
+
+        if toCredit > 0:
+            stream.uncredited -= toCredit
+            self._queueToClient(packWindowFrame(stream.streamId, toCredit))
+
+    def _readFromEndpoint(self, stream, readLen):
+        try:
+            nextData = stream.endpointSocket.recv(readLen)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK_ERRNOS:
+                return
+            nextData = ''
+
+        if not nextData:
+            self._removeStream(stream, '')
+            return
+
+        if stream.endpointAdaptive is not None:
+            stream.endpointAdaptive.update(len(nextData), readLen)
+        if self.outgoingLimiters:
+            self._consumeLimiters(self.outgoingLimiters, len(nextData))
+        stream.sendWindow -= len(nextData)
+        self._queueToClient(packDataFrames(stream.streamId, nextData))
+        self._markFirstByte()
+
+    def run(self):
+
+        signal.signal(signal.SIGTERM, self._closeConnectionsAndExit)
+        signal.signal(signal.SIGINT, self._closeConnectionsAndExit)
+
+        signal.signal(signal.SIGUSR1, self.startProfiling)
+        signal.siginterrupt(signal.SIGUSR1, False)
+
+        if self.initialProfileSeconds:
+            self._startProfiler(self.initialProfileSeconds)
+
+        clientSocket = self.clientSocket
+
+        if self.socketOptions:
+            self._applySocketOptions(clientSocket)
+        clientSocket.setblocking(0)
+
+        clientBufferLen = self.clientBufferLen
+        endpointBufferLen = self.endpointBufferLen
+
+        incomingLimiters = self.incomingLimiters
+        outgoingLimiters = self.outgoingLimiters
+
+        streams = self.streams
+        frameReader = FrameReader()
+
+        if self.adaptiveBuffers is True:
+            clientAdaptive = AdaptiveBufferLen(clientBufferLen)
+        else:
+            clientAdaptive = None
+
+        clientFd = clientSocket.fileno()
+
+        try:
+            # Frames (e.x. the first FRAME_OPEN) which the client sent right behind its password
+            if self.initialClientData:
+                if incomingLimiters:
+                    self._consumeLimiters(incomingLimiters, len(self.initialClientData))
+                for (streamId, frameType, payload) in frameReader.feed(self.initialClientData):
+                    self._handleClientFrame(streamId, frameType, payload)
+
+            while True:
+                if clientAdaptive is not None:
+                    clientBufferLen = clientAdaptive.bufferLen
+
+                poller = select.poll()
+                selectTimeout = .2
+
+                canQueueToClient = bool(len(self.toClient) < MAX_PENDING_TO_CLIENT)
+
+                clientEvents = 0
+                clientReadLen = self._getAllowedReadLen(incomingLimiters, clientBufferLen)
+                if clientReadLen > 0:
+                    if canQueueToClient:
+                        clientEvents |= select.POLLIN
+                else:
+                    selectTimeout = min(selectTimeout, self._getLimiterDelay(incomingLimiters, clientBufferLen))
+
+                if self.toClient:
+                    clientEvents |= select.POLLOUT
+
+                # Errors and hangups on the client are always reported
+                poller.register(clientFd, clientEvents)
+
+                endpointReadLen = self._getAllowedReadLen(outgoingLimiters, endpointBufferLen)
+
+                # fd -> (stream, waiting to read, waiting to write)
+                fdToStream = {}
+                for stream in streams.values():
+                    waitingToWrite = bool(not stream.connected or stream.toEndpoint)
+
+                    waitingToRead = False
+                    if stream.connected and not stream.closing and stream.sendWindow > 0 and canQueueToClient:
+                        if endpointReadLen > 0:
+                            waitingToRead = True
+                        else:
+                            selectTimeout = min(selectTimeout, self._getLimiterDelay(outgoingLimiters, endpointBufferLen))
+
+                    if not waitingToRead and not waitingToWrite:
+                        continue
+
+                    endpointFd = stream.endpointSocket.fileno()
+                    fdToStream[endpointFd] = (stream, waitingToRead, waitingToWrite)
+                    poller.register(endpointFd, (waitingToRead and select.POLLIN or 0) | (waitingToWrite and select.POLLOUT or 0))
+
+                try:
+                    pollResults = poller.poll(int(math.ceil(selectTimeout * 1000)))
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                readyForRead = []
+                readyForWrite = []
+                clientReadable = clientError = False
+                for (fd, events) in pollResults:
+                    if fd == clientFd:
+                        clientError = bool(events & (select.POLLERR | select.POLLNVAL))
+                        # A hangup is picked up by the read returning nothing
+                        clientReadable = bool(events & (select.POLLIN | select.POLLHUP))
+                        continue
+
+                    (stream, waitingToRead, waitingToWrite) = fdToStream[fd]
+                    # An error or hangup is picked up by whichever of the connect check, send, or recv comes next
+                    if waitingToWrite and events & POLL_WRITE_EVENTS:
+                        readyForWrite.append(stream)
+                    if waitingToRead and events & POLL_READ_EVENTS:
+                        readyForRead.append(stream)
+
+                if clientError:
+                    break
+
+                if clientReadable:
+                    try:
+                        nextData = clientSocket.recv(clientReadLen)
+                    except socket.error as e:
+                        if e.args[0] not in WOULD_BLOCK_ERRNOS:
+                            raise
+                        nextData = None
+
+                    if nextData == '':
+                        break
+                    if nextData:
+                        if incomingLimiters:
+                            self._consumeLimiters(incomingLimiters, len(nextData))
+                        if clientAdaptive is not None:
+                            clientAdaptive.update(len(nextData), clientReadLen)
+                        for (streamId, frameType, payload) in frameReader.feed(nextData):
+                            self._handleClientFrame(streamId, frameType, payload)
+
+                for stream in readyForWrite:
+                    if stream.streamId not in streams:
+                        continue
+                    if not stream.connected:
+                        self._finishConnect(stream)
+                    else:
+                        self._flushToEndpoint(stream)
+
+                for stream in readyForRead:
+                    if stream.streamId not in streams:
+                        continue
+                    if stream.endpointAdaptive is not None:
+                        streamBufferLen = stream.endpointAdaptive.bufferLen
+                    else:
+                        streamBufferLen = endpointBufferLen
+                    readLen = min(self._getAllowedReadLen(outgoingLimiters, streamBufferLen), stream.sendWindow)
+                    if readLen > 0:
+                        self._readFromEndpoint(stream, readLen)
+
+                if self.toClient:
+                    self._flushToClient()
+
+        except MultiplexProtocolError as e:
+            sys.stderr.write('Multiplex protocol error from %s: %s\n' %(str(self.clientAddr), str(e)))
+        except socket.error as e:
+            sys.stderr.write('Socket error on multiplexed connection from %s: %s\n' %(str(self.clientAddr), str(e)))
+        except Exception as e:
+            sys.stderr.write('Unexpected error on multiplexed connection from %s: %s\n' %(str(self.clientAddr), str(e)))
+            sys.stderr.write(traceback.format_exc(sys.exc_info()) + '\n')
+        finally:
+            # Always shut down the client, even on an unexpected error. The Listener still holds a copy of the fd,
+            #  so only an explicit shutdown lets the client see the connection end.
+            self._closeConnectionsAndExit()
+
+
+# vim: ts=4 sw=4 expandtab
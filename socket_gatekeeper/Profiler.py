@@ -0,0 +1,175 @@
+###
+#    Copyright (c) 2015 Timothy Savannah <kata198@gmail.com> LGPL v2.1
+#    See LICENSE for more information, or https://gnu.org/licenses/old-licenses/lgpl-2.1.txt
+###
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+DEFAULT_PROFILE_SECONDS = 30
+DEFAULT_SAMPLE_INTERVAL = .005
+
+
+def getDefaultProfileDir():
+    return tempfile.gettempdir()
+
+
+class SamplingProfiler(object):
+    '''
+        SamplingProfiler - A low-overhead profiler which periodically samples the stacks of every thread in this process.
+
+        Sampling runs in a background thread, so it covers the Listener's connection threads as well as its main loop.
+          The output is written when the run completes, one line per unique stack, in the "collapsed" format
+          (frames joined by ';' followed by a sample count) which flamegraph tools accept.
+    '''
+
+    def __init__(self, outputFilename, interval=DEFAULT_SAMPLE_INTERVAL):
+        '''
+            outputFilename - File to write the results to
+            interval - Seconds between samples
+        '''
+        self.outputFilename = outputFilename
+        self.interval = interval
+
+        self.samples = {}
+        self.numSamples = 0
+        self.thread = None
+        self.keepGoing = False
+        self.endTime = None
+
+    def isRunning(self):
+        return bool(self.thread is not None and self.thread.is_alive())
+
+    def getRemainingSeconds(self):
+        '''
+            getRemainingSeconds - Returns the number of seconds left in the current run, or 0 if not running.
+        '''
+        if not self.isRunning():
+            return 0
+        return max(0, self.endTime - time.time())
+
+    def start(self, seconds):
+        '''
+            start - Start sampling for #seconds in a background thread. Does nothing if already running.
+
+            @return - True if started, False if already running.
+        '''
+        if self.isRunning():
+            return False
+
+        self.samples = {}
+        self.numSamples = 0
+        self.keepGoing = True
+        self.endTime = time.time() + seconds
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def stop(self):
+        '''
+            stop - Stop sampling early, and wait for the output (of what has been sampled so far) to be written.
+        '''
+        self.keepGoing = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        interval = self.interval
+        startTime = time.time()
+        endTime = self.endTime
+        while self.keepGoing is True and time.time() < endTime:
+            self._sample()
+            time.sleep(interval)
+
+        try:
+            self._writeOutput(time.time() - startTime)
+        except Exception as e:
+            sys.stderr.write('Failed to write profile to "%s": %s\n' %(self.outputFilename, str(e)))
+
+    def _sample(self):
+        samples = self.samples
+        myIdent = threading.current_thread().ident
+        # After a fork (e.x. a Handler started from one of the Listener's connection threads), python 2 still reports
+        #  the frames of threads which only existed in the parent. Only sample threads which are alive in this process.
+        liveIdents = set([thread.ident for thread in threading.enumerate()])
+        for (threadIdent, frame) in sys._current_frames().items():
+            if threadIdent == myIdent or threadIdent not in liveIdents:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' %(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            stack.reverse()
+            key = ';'.join(stack)
+            samples[key] = samples.get(key, 0) + 1
+
+        self.numSamples += 1
+
+    def _writeOutput(self, elapsed):
+        with open(self.outputFilename, 'w') as f:
+            f.write('# pid %d, %d samples over %1.2f seconds\n' %(os.getpid(), self.numSamples, elapsed))
+            for (stack, count) in sorted(self.samples.items(), key=lambda item : item[1], reverse=True):
+                f.write('%s %d\n' %(stack, count))
+
+        sys.stderr.write('Wrote profile of pid %d to %s\n' %(os.getpid(), self.outputFilename))
+
+
+def markTrace(sessionTrace, eventName, value=None):
+    '''
+        markTrace - Mark #eventName on #sessionTrace, if it is not None, and return #value.
+
+          Lets a step be traced in the middle of an expression, without an intermediate variable.
+    '''
+    if sessionTrace is not None:
+        sessionTrace.mark(eventName)
+    return value
+
+
+class SessionTrace(object):
+    '''
+        SessionTrace - Records when each stage of a session happened, from accept to the first relayed byte.
+
+        Created by the Listener on accept, and passed to the Handler, which writes it out as a single line
+          with each event's offset in milliseconds from accept.
+    '''
+
+    def __init__(self, clientAddr, outputFilename, acceptTime=None):
+        '''
+            clientAddr - Address of the client
+            outputFilename - File to append the trace to
+            acceptTime - time.time() when the connection was accepted. Defaults to now.
+        '''
+        self.clientAddr = clientAddr
+        self.outputFilename = outputFilename
+
+        self.events = [ ('accept', acceptTime or time.time()) ]
+
+    def mark(self, eventName):
+        self.events.append( (eventName, time.time()) )
+
+    def format(self):
+        startTime = self.events[0][1]
+        clientAddr = self.clientAddr
+        if isinstance(clientAddr, tuple):
+            clientAddr = '%s:%s' %clientAddr[:2]
+        return 'pid=%d client=%s start=%f %s' %(os.getpid(), clientAddr, startTime, ' '.join(['%s=%1.3fms' %(name, (when - startTime) * 1000.0) for (name, when) in self.events]))
+
+    def write(self):
+        '''
+            write - Append this trace to its output file. A single write, so traces from several Handlers do not interleave.
+        '''
+        try:
+            with open(self.outputFilename, 'a') as f:
+                f.write(self.format() + '\n')
+        except Exception as e:
+            sys.stderr.write('Failed to write session trace to "%s": %s\n' %(self.outputFilename, str(e)))
+
+
+# vim: ts=4 sw=4 expandtab
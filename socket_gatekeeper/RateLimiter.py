@@ -0,0 +1,128 @@
+###
+#    Copyright (c) 2015 Timothy Savannah <kata198@gmail.com> LGPL v2.1
+#    See LICENSE for more information, or https://gnu.org/licenses/old-licenses/lgpl-2.1.txt
+###
+
+import multiprocessing
+import time
+
+from .utils import parseSize
+
+
+# Smallest and largest amount of time a Handler will wait on a drained bucket before checking again
+MIN_LIMITER_DELAY = .001
+MAX_LIMITER_DELAY = .2
+
+
+def parseRate(value):
+    '''
+        parseRate - Parse a rate value, in bytes per second. Accepts an integer with an optional K, M, or G suffix (powers of 1024).
+
+        @see parseSize
+    '''
+    return parseSize(value)
+
+
+class TokenBucket(object):
+    '''
+        TokenBucket - Limits throughput to a number of bytes per second, allowing bursts up to "burst" bytes.
+
+        Use "available" to find how many bytes may be transferred now, and "consume" to record the bytes actually transferred.
+          The bucket may go into debt (if more is consumed than was available), which is paid back before anything more is allowed.
+
+        This object is local to a single process. @see SharedTokenBucket for a bucket shared by several Handlers.
+    '''
+
+    def __init__(self, rate, burst=None):
+        '''
+            rate - Bytes per second
+            burst - Maximum bytes which may accumulate while idle. Defaults to one second worth of "rate".
+        '''
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+
+        self.tokens = self.burst
+        self.lastTime = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + ((now - self.lastTime) * self.rate))
+        self.lastTime = now
+
+    def available(self):
+        '''
+            available - Returns the number of bytes which may be transferred right now.
+        '''
+        self._refill()
+        return max(0, int(self.tokens))
+
+    def consume(self, numBytes):
+        '''
+            consume - Record that #numBytes have been transferred.
+        '''
+        self._refill()
+        self.tokens -= numBytes
+
+    def getQuantum(self, bufferLen):
+        '''
+            getQuantum - Returns the smallest number of bytes worth waking up to transfer, for a buffer of #bufferLen.
+
+              Waiting for a quantum (rather than any single byte) keeps slow rates from turning into a recv/send per byte.
+        '''
+        return max(1, min(bufferLen, int(self.rate * MAX_LIMITER_DELAY)))
+
+    def getDelay(self, numBytes=1):
+        '''
+            getDelay - Returns the number of seconds until at least #numBytes are available.
+        '''
+        self._refill()
+        if self.tokens >= numBytes:
+            return 0
+        return (numBytes - self.tokens) / self.rate
+
+
+class SharedTokenBucket(TokenBucket):
+    '''
+        SharedTokenBucket - A TokenBucket whose state is shared across processes, used to limit the total throughput of
+          every Handler on a single mapping.
+
+        This must be created before the Handlers are started (forked), e.x. in the Listener.
+
+        Each Handler only takes up to its buffer length per loop, so concurrent sessions interleave their use of the bucket
+          and end up with a roughly equal share of it.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+
+        # [ tokens, lastTime ]
+        self.state = multiprocessing.Array('d', [self.burst, time.time()])
+
+    def _refill(self):
+        # Caller must hold the lock
+        state = self.state
+        now = time.time()
+        state[0] = min(self.burst, state[0] + ((now - state[1]) * self.rate))
+        state[1] = now
+
+    def available(self):
+        with self.state.get_lock():
+            self._refill()
+            return max(0, int(self.state[0]))
+
+    def consume(self, numBytes):
+        with self.state.get_lock():
+            self._refill()
+            self.state[0] -= numBytes
+
+    def getDelay(self, numBytes=1):
+        with self.state.get_lock():
+            self._refill()
+            tokens = self.state[0]
+        if tokens >= numBytes:
+            return 0
+        return (numBytes - tokens) / self.rate
+
+
+# vim: ts=4 sw=4 expandtab
@@ -16,6 +16,45 @@ def closeSocket(openSocket):
     except:
         pass
 
+SIZE_SUFFIXES = {
+    'K' : 1024,
+    'M' : 1024 * 1024,
+    'G' : 1024 * 1024 * 1024,
+}
+
+def parseSize(value):
+    '''
+        parseSize - Parse a size in bytes. Accepts an integer with an optional K, M, or G suffix (powers of 1024).
+
+        @param value - String, e.x. "65536", "64K", or "10M"
+
+        @return - Integer bytes. Raises ValueError on invalid or non-positive values.
+    '''
+    value = value.strip().upper()
+    multiplier = 1
+    if value and value[-1] in SIZE_SUFFIXES:
+        multiplier = SIZE_SUFFIXES[value[-1]]
+        value = value[:-1]
+
+    if value.isdigit() is False:
+        raise ValueError('"%s" must be an integer, optionally followed by K, M, or G.' %(value,))
+
+    ret = int(value) * multiplier
+    if ret <= 0:
+        raise ValueError('Must be greater than 0.')
+
+    return ret
+
+def parseBool(value):
+    '''
+        parseBool - Parse a boolean option value: yes/no, true/false, on/off, or 1/0.
+    '''
+    value = value.strip().lower()
+    if value in ('yes', 'true', 'on', '1'):
+        return True
+    if value in ('no', 'false', 'off', '0'):
+        return False
+    raise ValueError('"%s" must be one of yes/no, true/false, on/off, 1/0.' %(value,))
 
 
 # vim: ts=4 sw=4 expandtab